@@ -1,6 +1,16 @@
 from sqlalchemy import Column,Integer,String,DateTime,Text,Boolean
-from database import Base,engine,SessionLocal
+from database import Base,engine
 from datetime import datetime
+import asyncio
+import logging
+
+logger=logging.getLogger(__name__)
+
+# Flush when this many rows are pending or this long after the first one
+BATCH_SIZE=500
+FLUSH_INTERVAL=0.05
+# Rows held while the database is slow/unavailable; beyond this they are dropped
+QUEUE_SIZE=10_000
 
 class APDULog(Base):
     __tablename__="apdu_log"
@@ -11,10 +21,63 @@ class APDULog(Base):
     success=Column(Boolean)
     timestamp=Column(DateTime,default=datetime.utcnow)
 
-Base.metadata.create_all(engine)
+_log_queue:asyncio.Queue=asyncio.Queue(maxsize=QUEUE_SIZE)
+_dropped=0
 
 def log_apdu(device_id,cmd,rsp,success):
-    db=SessionLocal()
-    db.add(APDULog(device_id=device_id,apdu_command=cmd,
-        apdu_response=rsp,success=success))
-    db.commit();db.close()
+    # Non-blocking: rows are written by drain_logs()
+    global _dropped
+    try:
+        _log_queue.put_nowait({"device_id":device_id,"apdu_command":cmd,
+            "apdu_response":rsp,"success":success,"timestamp":datetime.utcnow()})
+    except asyncio.QueueFull:
+        _dropped+=1
+        if _dropped%1000==1:
+            logger.warning(f"⚠️ APDU log queue full, {_dropped} rows dropped")
+
+def _insert_batch(rows):
+    with engine.begin() as conn:
+        conn.execute(APDULog.__table__.insert(),rows)
+
+async def _collect(rows):
+    loop=asyncio.get_running_loop()
+    rows.append(await _log_queue.get())
+    deadline=loop.time()+FLUSH_INTERVAL
+    while len(rows)<BATCH_SIZE:
+        try:
+            rows.append(_log_queue.get_nowait())
+            continue
+        except asyncio.QueueEmpty:
+            pass
+        timeout=deadline-loop.time()
+        if timeout<=0:
+            break
+        try:
+            rows.append(await asyncio.wait_for(_log_queue.get(),timeout))
+        except asyncio.TimeoutError:
+            break
+
+async def drain_logs():
+    # Runs until cancelled, then writes whatever is still pending
+    rows=[]
+    try:
+        while True:
+            await _collect(rows)
+            batch,rows=rows,[]
+            try:
+                await asyncio.to_thread(_insert_batch,batch)
+            except Exception as e:
+                logger.error(f"❌ APDU log flush failed ({len(batch)} rows): {e}")
+    except asyncio.CancelledError:
+        try:
+            flush_logs(rows)
+        except Exception as e:
+            logger.error(f"❌ APDU log flush at shutdown failed: {e}")
+        raise
+
+def flush_logs(rows=None):
+    rows=list(rows or [])
+    while not _log_queue.empty():
+        rows.append(_log_queue.get_nowait())
+    if rows:
+        _insert_batch(rows)
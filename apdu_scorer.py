@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+from typing import List
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MODEL_PATH = "apdu_model.joblib"
+ONNX_MODEL_PATH = "apdu_model.onnx"
+# Hummingbird GEMM export: the forest as dense matrix multiplies
+HB_ONNX_MODEL_PATH = "apdu_model.hb.onnx"
+
+# Requests queued while the previous batch is scored go out together; a lone
+# request is scored as soon as it arrives
+BATCH_SIZE = 256
+
+vectorizer, rf_model, onnx_session = None, None, None
+
+# Try to load ML model
+try:
+    from joblib import load
+    vectorizer, rf_model = load(MODEL_PATH)
+    # Single-row predicts gain nothing from joblib's thread pool
+    rf_model.n_jobs = 1
+    # Column of predict_proba holding P(success)
+    _success_col = list(rf_model.classes_).index(1)
+    logger.info("✅ Loaded APDU ML model")
+except Exception as e:
+    vectorizer, rf_model = None, None
+    logger.warning(f"⚠️ ML model not available: {e}")
+
+available = rf_model is not None
+
+def _forest_proba(X) -> np.ndarray:
+    # Same average as ForestClassifier.predict_proba, without re-validating the
+    # input for every tree or dispatching through joblib
+    X = X.tocsr().astype(np.float32)
+    trees = rf_model.estimators_
+    proba = trees[0].predict_proba(X, check_input=False)
+    for tree in trees[1:]:
+        proba += tree.predict_proba(X, check_input=False)
+    return proba / len(trees)
+
+# Probe rows an ONNX export must score like the forest before it is used
+_PROBE = ["00A4040007A0000000031010|9000", "00B2010C00|6A82", "FFFF|6D00"]
+
+def _load_onnx(path):
+    import onnxruntime as ort
+    opts = ort.SessionOptions()
+    opts.intra_op_num_threads = 1
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = ort.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"])
+    # skl2onnx and Hummingbird name the input differently
+    name = session.get_inputs()[0].name
+    X = vectorizer.transform(_PROBE)
+    probs = session.run(None, {name: X.toarray().astype(np.float32)})[1]
+    # Output [1] must be per-class probabilities in classes_ order
+    if probs.shape != (len(_PROBE), len(rf_model.classes_)):
+        raise ValueError(f"unexpected probability shape {probs.shape}")
+    if not np.allclose(probs, _forest_proba(X), atol=1e-4):
+        raise ValueError("probabilities differ from the scikit-learn forest")
+    return session, name
+
+# Prefer an ONNX export of the forest when one is present and checks out
+if rf_model is not None:
+    for onnx_path in (HB_ONNX_MODEL_PATH, ONNX_MODEL_PATH):
+        if not os.path.exists(onnx_path):
+            continue
+        try:
+            onnx_session, _onnx_input = _load_onnx(onnx_path)
+            logger.info(f"✅ Using ONNX scorer ({onnx_path})")
+            break
+        except Exception as e:
+            onnx_session = None
+            logger.warning(f"⚠️ Ignoring {onnx_path}: {e}")
+    else:
+        logger.info("ℹ️ ONNX scorer not available, using scikit-learn")
+
+def score_many(combos: List[str]) -> List[float]:
+    """Probability that each command|response pair is a successful exchange."""
+    X = vectorizer.transform(combos)
+    if onnx_session is not None:
+        probs = onnx_session.run(None, {_onnx_input: X.toarray().astype(np.float32)})[1]
+    else:
+        probs = _forest_proba(X)
+    return probs[:, _success_col].tolist()
+
+def score(combo: str) -> float:
+    return score_many([combo])[0]
+
+_score_queue: asyncio.Queue = asyncio.Queue()
+_batcher_running = False
+
+async def score_async(combo: str) -> float:
+    # Without the batcher (e.g. outside the app) score inline
+    if not _batcher_running:
+        return score(combo)
+    future = asyncio.get_running_loop().create_future()
+    _score_queue.put_nowait((combo, future))
+    return await future
+
+async def _collect(batch):
+    # Never waits for more work once something is queued
+    batch.append(await _score_queue.get())
+    while len(batch) < BATCH_SIZE and not _score_queue.empty():
+        batch.append(_score_queue.get_nowait())
+
+async def run_batcher():
+    # Runs until cancelled; pending callers are cancelled with it
+    global _batcher_running
+    _batcher_running = True
+    batch = []
+    try:
+        while True:
+            await _collect(batch)
+            try:
+                probs = await asyncio.to_thread(score_many, [combo for combo, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), prob in zip(batch, probs):
+                    if not future.done():
+                        future.set_result(prob)
+            batch = []
+    finally:
+        _batcher_running = False
+        while not _score_queue.empty():
+            batch.append(_score_queue.get_nowait())
+        for _, future in batch:
+            future.cancel()
@@ -0,0 +1,39 @@
+from typing import Dict, Optional
+from sqlalchemy import select
+
+from database import AsyncSessionLocal
+from models import Card
+
+# Stored cards by id, in the card_data shape the APDU processor reads.
+# Warmed at startup and updated in place when a card is created. Each worker
+# has its own copy, so a miss (e.g. a card created on another worker) falls
+# back to the database.
+_CARD_CACHE: Dict[int, dict] = {}
+
+def _card_data(card: Card) -> dict:
+    return {
+        "pan": card.pan,
+        "expiry": card.expiry.isoformat(),
+        "holder_name": card.holder_name,
+        "issuer_id": card.issuer_id,
+    }
+
+async def warm():
+    async with AsyncSessionLocal() as session:
+        cards = await session.scalars(select(Card))
+        _CARD_CACHE.clear()
+        _CARD_CACHE.update({card.id: _card_data(card) for card in cards})
+
+def put(card: Card):
+    _CARD_CACHE[card.id] = _card_data(card)
+
+async def get(card_id: int) -> Optional[dict]:
+    cached = _CARD_CACHE.get(card_id)
+    if cached is not None:
+        return cached
+    async with AsyncSessionLocal() as session:
+        card = await session.get(Card, card_id)
+    if card is None:
+        return None
+    put(card)
+    return _CARD_CACHE[card_id]
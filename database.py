@@ -1,12 +1,52 @@
 from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Date, Numeric
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-from settings import DATABASE_URL
+from settings import DATABASE_URL, SQL_ECHO
 
-# Create a SQLAlchemy engine and base class
-engine = create_engine(DATABASE_URL, echo=True)
+def _pool_sizing(url: str, pool_size: int, max_overflow: int) -> dict:
+    # SQLite picks its own pool (SingletonThreadPool/StaticPool for :memory:),
+    # which rejects the QueuePool sizing arguments
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {"pool_size": pool_size, "max_overflow": max_overflow}
+
+# Create a SQLAlchemy engine and base class. Request handlers use the async
+# engine below; this one only serves the APDU log writer thread and startup,
+# so it keeps a small pool (connections are per worker process).
+engine = create_engine(
+    DATABASE_URL,
+    echo=SQL_ECHO,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    **_pool_sizing(DATABASE_URL, 2, 2),
+)
 metadata = MetaData()
 Base = declarative_base(metadata=metadata)
 
 # Session factory – we will use this everywhere
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Async engine on the same database for request handlers, so they don't hold
+# a threadpool worker while waiting on I/O
+_ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+def _async_url(url: str):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in _ASYNC_DRIVERS:
+        raise ValueError(
+            f"DATABASE_URL backend {backend!r} has no async driver configured; "
+            f"supported: {', '.join(_ASYNC_DRIVERS)}"
+        )
+    return url.set(drivername=f"{backend}+{_ASYNC_DRIVERS[backend]}")
+
+async_engine = create_async_engine(
+    _async_url(DATABASE_URL),
+    echo=SQL_ECHO,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    **_pool_sizing(DATABASE_URL, 20, 10),
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
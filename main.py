@@ -1,223 +1,458 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from routers import cards
+import card_cache
 from database import engine, Base
-import json
+from settings import REDIS_URL, CORS_ORIGINS, APDU_HISTORY_SIZE, UVICORN_RELOAD, WEB_CONCURRENCY
+from schemas import ClientMessage, InitMsg, ApduCommand, ApduResponse, Heartbeat, ErrorMsg
+import msgspec
 import logging
 import asyncio
-from datetime import datetime
-from typing import Dict, List
+from datetime import datetime, timezone
+import time
+from typing import Deque, Dict, List, Tuple
+from collections import deque
+import itertools
+from types import MappingProxyType
 import uuid
 
-# Try to load ML model
-try:
-    from joblib import load
-    vectorizer, rf_model = load("apdu_model.joblib")
-    logging.info("✅ Loaded APDU ML model")
-except Exception as e:
-    vectorizer, rf_model = None, None
-    logging.warning(f"⚠️ ML model not available: {e}")
+# WebSocket codec (MessagePack, see README)
+_decoder = msgspec.msgpack.Decoder(ClientMessage)
+_encoder = msgspec.msgpack.Encoder()
+# Replies that never change are encoded once
+_HEARTBEAT_FRAME = _encoder.encode(Heartbeat())
+_BAD_HEX_FRAME = _encoder.encode(ErrorMsg(message="Command is not valid hex"))
+_TEXT_FRAME = _encoder.encode(ErrorMsg(message="Messages must be binary MessagePack frames"))
+_BAD_CARD_FRAME = _encoder.encode(ErrorMsg(message="card_data needs a pan of up to 19 digits and YYYY-MM-DD expiry"))
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ML model (imported after logging is configured so its load status is logged)
+import apdu_scorer
+
+# APDU logging is optional; importing it also registers APDULog on Base
+try:
+    from apdu_logger import log_apdu, drain_logs
+except ImportError:
+    log_apdu = drain_logs = None
+
 app = FastAPI(
     title="POS-to-NFC API with APDU Processing",
     version="2.1.0",
-    description="Enhanced FastAPI backend with real-time APDU processing capabilities"
+    description="Enhanced FastAPI backend with real-time APDU processing capabilities",
+    default_response_class=ORJSONResponse
 )
 
-# CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# CORS (REST only: the middleware passes WebSocket scopes straight through)
+if CORS_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=CORS_ORIGINS,
+        allow_credentials=True,
+        allow_methods=["GET", "POST"],
+        allow_headers=["*"],
+    )
 
 # DB
-Base.metadata.create_all(engine)
+@app.on_event("startup")
+def create_tables():
+    Base.metadata.create_all(engine)
+
+@app.on_event("startup")
+async def warm_card_cache():
+    await card_cache.warm()
+
+def _iso(ts_ns: int) -> str:
+    # Wall-clock time_ns() -> ISO-8601 (UTC); only called when a response is rendered
+    return datetime.fromtimestamp(ts_ns / 1e9, tz=timezone.utc).isoformat()
+
+class DeviceInfo:
+    # connected_at is wall-clock; last_activity_ns is monotonic (cheap, jump-free)
+    __slots__ = ("connected_at", "last_activity_ns", "apdu_count")
+
+    def __init__(self):
+        self.connected_at = time.time_ns()
+        self.last_activity_ns = time.monotonic_ns()
+        self.apdu_count = 0
 
 # Connection manager
+BROADCAST_CHANNEL = "channel:broadcast"
+OUTBOX_SIZE = 256
+_CLOSE = object()  # outbox sentinel: sender closes the socket and exits
+
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, redis_url: str = None):
         self.active_connections: Dict[str, WebSocket] = {}
-        self.device_info: Dict[str, Dict] = {}
+        self.device_info: Dict[str, DeviceInfo] = {}
+        # One outbound queue + sender task per device, so APDU handling never
+        # waits on a slow socket
+        self.outboxes: Dict[str, asyncio.Queue] = {}
+        self.senders: Dict[str, asyncio.Task] = {}
+        # With Redis, broadcasts go through pub/sub so every worker delivers them
+        self.redis = None
+        if redis_url:
+            import redis.asyncio as aioredis
+            self.redis = aioredis.from_url(redis_url)
 
     async def connect(self, websocket: WebSocket, device_id: str):
         await websocket.accept()
         self.active_connections[device_id] = websocket
-        self.device_info[device_id] = {
-            "connected_at": datetime.utcnow(),
-            "last_activity": datetime.utcnow(),
-            "apdu_count": 0
-        }
+        self.device_info[device_id] = DeviceInfo()
+        outbox = asyncio.Queue(maxsize=OUTBOX_SIZE)
+        self.outboxes[device_id] = outbox
+        self.senders[device_id] = asyncio.create_task(self._sender(device_id, websocket, outbox))
         logger.info(f"📱 Device {device_id} connected")
 
     def disconnect(self, device_id: str):
-        self.active_connections.pop(device_id, None)
+        if self.active_connections.pop(device_id, None) is None:
+            return
         self.device_info.pop(device_id, None)
+        self.outboxes.pop(device_id, None)
+        sender = self.senders.pop(device_id, None)
+        if sender is not None and sender is not asyncio.current_task():
+            sender.cancel()
         logger.info(f"📱 Device {device_id} disconnected")
 
-    async def send_personal_message(self, message: dict, device_id: str):
-        ws = self.active_connections.get(device_id)
-        if ws:
+    def drop(self, device_id: str):
+        # Manager-side disconnect. Emptying the outbox wakes an endpoint blocked
+        # in send_frame; _CLOSE then has the sender close the socket so the
+        # endpoint's receive ends too.
+        outbox = self.outboxes.get(device_id)
+        sender = self.senders.pop(device_id, None)
+        self.disconnect(device_id)
+        if outbox is None:
+            return
+        while not outbox.empty():
+            outbox.get_nowait()
+        if sender is not None and sender is not asyncio.current_task():
+            outbox.put_nowait(_CLOSE)
+
+    async def _sender(self, device_id: str, ws: WebSocket, outbox: asyncio.Queue):
+        # Write everything already queued back-to-back before waiting again
+        try:
+            while True:
+                frames = [await outbox.get()]
+                while not outbox.empty():
+                    frames.append(outbox.get_nowait())
+                for payload in frames:
+                    if payload is _CLOSE:
+                        await ws.close(code=1011)
+                        return
+                    await ws.send_bytes(payload)
+        except Exception as e:
+            logger.error(f"❌ Send error to {device_id}: {e}")
+            self.drop(device_id)
+
+    async def send_personal_message(self, message: msgspec.Struct, device_id: str):
+        await self.send_frame(_encoder.encode(message), device_id)
+
+    async def send_frame(self, payload: bytes, device_id: str):
+        # Waits only if this device's outbox is full
+        outbox = self.outboxes.get(device_id)
+        if outbox is None:
+            raise WebSocketDisconnect(code=1011)
+        await outbox.put(payload)
+
+    # Server-push API for all connected devices; no endpoint calls it yet
+    async def broadcast(self, message: msgspec.Struct):
+        payload = _encoder.encode(message)
+        if self.redis is not None:
+            await self.redis.publish(BROADCAST_CHANNEL, payload)
+        else:
+            self._fan_out(payload)
+
+    async def relay_broadcasts(self):
+        # Deliver broadcasts published by any worker to this worker's devices,
+        # resubscribing with backoff whenever Redis drops the connection
+        delay = 1
+        while True:
+            pubsub = self.redis.pubsub()
             try:
-                await ws.send_text(json.dumps(message))
-                self.device_info[device_id]["last_activity"] = datetime.utcnow()
+                await pubsub.subscribe(BROADCAST_CHANNEL)
+                delay = 1
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._fan_out(message["data"])
             except Exception as e:
-                logger.error(f"❌ Send error to {device_id}: {e}")
-                self.disconnect(device_id)
+                logger.error(f"❌ Broadcast relay error, retrying in {delay}s: {e}")
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def _fan_out(self, payload: bytes):
+        # Queue for every local device; one too far behind to accept it is dropped
+        for device_id, outbox in list(self.outboxes.items()):
+            try:
+                outbox.put_nowait(payload)
+            except asyncio.QueueFull:
+                logger.error(f"❌ Broadcast dropped, {device_id} outbox full")
+                self.drop(device_id)
 
     def get_connected_devices(self) -> List[str]:
         return list(self.active_connections.keys())
 
-manager = ConnectionManager()
+    @property
+    def connection_count(self) -> int:
+        return len(self.active_connections)
+
+manager = ConnectionManager(REDIS_URL)
+
+# EMV tables, shared by all processors and read-only
+_EMV_COMMANDS = MappingProxyType({
+    "SELECT": bytes.fromhex("00A40400"),
+    "GPO": bytes.fromhex("80A80000"),
+    "READ_RECORD": bytes.fromhex("00B2"),
+    "GET_DATA": bytes.fromhex("80CA"),
+    "GENERATE_AC": bytes.fromhex("80AE")
+})
+_EMV_SUCCESS = bytes.fromhex("9000")
+_EMV_FILE_NOT_FOUND = bytes.fromhex("6A82")
+_EMV_CMD_NOT_SUPPORTED = bytes.fromhex("6D00")
+_EMV_COND_NOT_SAT = bytes.fromhex("6985")
+
+# PSE and AID database
+_PSE_AID = b"2PAY.SYS.DDF01"
+_AID_DB = MappingProxyType({
+    bytes.fromhex("A0000000031010"): "VISA",
+    bytes.fromhex("A0000000041010"): "MASTERCARD",
+    bytes.fromhex("A000000025010901"): "AMEX",
+    bytes.fromhex("A0000001524010"): "DISCOVER"
+})
+_GET_DATA_RESPONSES = MappingProxyType({
+    bytes.fromhex("9F36"): bytes.fromhex("9F36020001"),  # ATC
+    bytes.fromhex("9F13"): bytes.fromhex("9F13020001"),  # Last Online ATC
+    bytes.fromhex("9F17"): bytes.fromhex("9F170103")     # PIN Try Counter
+})
+
+# Short-form BER lengths (0-127), prebuilt so _tlv never formats or allocates one
+_TLV_LEN = tuple(bytes((n,)) for n in range(128))
+
+def _tlv(tag: bytes, val: bytes) -> bytes:
+    if len(val) >= 128:
+        raise ValueError(f"TLV value too long for a one-byte length: {len(val)}")
+    return tag + _TLV_LEN[len(val)] + val
+
+class PreparedCard:
+    # Parsed card fields, kept apart from the client's card_data dict so a
+    # client can't supply them itself
+    __slots__ = ("pan_bytes", "expiry_yymmdd", "record")
+
+    def __init__(self, pan_bytes: bytes, expiry_yymmdd: bytes, record: bytes):
+        self.pan_bytes = pan_bytes
+        self.expiry_yymmdd = expiry_yymmdd
+        self.record = record
 
 # APDU Processor (Fixed)
 class APDUProcessor:
     def __init__(self):
-        self.command_history: List[dict] = []
-        self.emv_commands = {
-            "SELECT": "00A40400",
-            "GPO": "80A80000",
-            "READ_RECORD": "00B2",
-            "GET_DATA": "80CA",
-            "GENERATE_AC": "80AE"
+        # Only the most recent commands are kept; commands_processed is the total
+        self.command_history: Deque[Tuple[int, bytes]] = deque(maxlen=APDU_HISTORY_SIZE)
+        self.commands_processed = 0
+        # Dispatch on the command prefix: CLA+INS+P1+P2 first, then CLA+INS
+        handlers = {
+            "SELECT": self.handle_select,
+            "GPO": self.handle_gpo,
+            "READ_RECORD": self.handle_read_record,
+            "GET_DATA": self.handle_get_data,
+        }
+        self._dispatch = {
+            _EMV_COMMANDS[name]: handler for name, handler in handlers.items()
         }
-        self.emv_responses = {
-            "SUCCESS": "9000",
-            "FILE_NOT_FOUND": "6A82",
-            "CMD_NOT_SUPPORTED": "6D00",
-            "COND_NOT_SAT": "6985"
+        self._type_by_header = {
+            prefix[:2]: name for name, prefix in _EMV_COMMANDS.items()
         }
-        # PSE and AID database
-        self.pse_aid = "325041592E5359532E4444463031"
-        self.aid_database = {
-            "A0000000031010": "VISA",
-            "A0000000041010": "MASTERCARD", 
-            "A000000025010901": "AMEX",
-            "A0000001524010": "DISCOVER"
+        # Static responses, built once
+        # Complete SELECT reply (FCI + 9000) for the PSE and every known AID
+        self._select_response = {
+            aid: self.build_fci_response(aid, app_name)
+            for aid, app_name in _AID_DB.items()
         }
+        self._select_response[_PSE_AID] = self.build_pse_response()
+        self._gpo_response = self.build_gpo_response()
+        self._default_record = self.build_record(
+            bytes.fromhex("4111111111111111"), bytes.fromhex("250101")
+        )
 
-    async def process_apdu(self, cmd: str, card_data: dict = None) -> str:
-        cmd = cmd.upper().replace(" ", "")
-        self.command_history.append({
-            "timestamp": datetime.utcnow().isoformat(), 
-            "command": cmd
-        })
-        logger.info(f"🔵 Processing: {cmd}")
-
-        if cmd.startswith(self.emv_commands["SELECT"]):
-            response = self.handle_select(cmd, card_data)
-        elif cmd.startswith(self.emv_commands["GPO"]):
-            response = self.handle_gpo(cmd, card_data)
-        elif cmd.startswith(self.emv_commands["READ_RECORD"]):
-            response = self.handle_read_record(cmd, card_data)
-        elif cmd.startswith(self.emv_commands["GET_DATA"]):
-            response = self.handle_get_data(cmd, card_data)
+    async def process_apdu(self, cmd: bytes, card_data: dict = None) -> bytes:
+        # (time_ns, command); type and timestamp are resolved on read
+        self.command_history.append((time.time_ns(), cmd))
+        self.commands_processed += 1
+        cmd_hex = cmd.hex().upper()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"🔵 Processing: {cmd_hex}")
+
+        handler = self._dispatch.get(cmd[:4]) or self._dispatch.get(cmd[:2])
+        if handler:
+            # A malformed command gets a status word, not a dropped session
+            try:
+                response = handler(cmd, card_data)
+            except Exception as e:
+                logger.error(f"❌ Handler error: {e}")
+                response = _EMV_COND_NOT_SAT
         else:
-            response = self.emv_responses["CMD_NOT_SUPPORTED"]
+            response = _EMV_CMD_NOT_SUPPORTED
+        rsp_hex = response.hex().upper()
 
         # Log APDU
-        try:
-            from apdu_logger import log_apdu
-            success = response.endswith(self.emv_responses["SUCCESS"])
-            log_apdu("ws_device", cmd, response, success)
-        except ImportError:
-            pass
+        if log_apdu is not None:
+            log_apdu("ws_device", cmd_hex, rsp_hex, response.endswith(_EMV_SUCCESS))
 
         # ML adjustment
-        if vectorizer and rf_model:
+        if apdu_scorer.available:
             try:
-                combo = f"{cmd}|{response}"
-                prob = rf_model.predict_proba(vectorizer.transform([combo]))
+                prob = await apdu_scorer.score_async(f"{cmd_hex}|{rsp_hex}")
                 if prob < 0.5:
                     logger.warning(f"🤖 ML suggests alternative response")
-                    response = self.emv_responses["FILE_NOT_FOUND"]
+                    response = _EMV_FILE_NOT_FOUND
+                    rsp_hex = response.hex().upper()
             except Exception as e:
                 logger.error(f"❌ ML error: {e}")
 
-        logger.info(f"🟢 Response: {response}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"🟢 Response: {rsp_hex}")
         return response
 
-    def handle_select(self, cmd: str, card_data: dict = None) -> str:
-        # Extract AID from command
-        try:
-            length = int(cmd[10:12], 16) * 2
-            aid = cmd[12:12+length] if len(cmd) >= 12 + length else ""
-            logger.info(f"📱 SELECT AID: {aid}")
-            
-            # Handle PSE
-            if aid.upper() == self.pse_aid:
-                logger.info("🏦 PSE Directory requested")
-                # Build minimal PSE FCI
-                df_name = "315041592E5359532E4444463031"  # "1PAY.SYS.DDF01"
-                fci = f"6F0E84{len(df_name)//2:02X}{df_name}"
-                return fci + self.emv_responses["SUCCESS"]
-            
-            # Handle application AIDs
-            if aid in self.aid_database:
-                app_name = self.aid_database[aid]
-                logger.info(f"✅ AID found: {app_name}")
-                # Build application FCI
-                aid_tag = f"84{len(aid)//2:02X}{aid}"
-                label_hex = app_name.encode().hex().upper()
-                label_tag = f"50{len(label_hex)//2:02X}{label_hex}"
-                fci = f"6F{(len(aid_tag + label_tag)//2):02X}{aid_tag}{label_tag}"
-                return fci + self.emv_responses["SUCCESS"]
-            
-            logger.warning(f"❌ AID not supported: {aid}")
-            return self.emv_responses["FILE_NOT_FOUND"]
-            
-        except Exception as e:
-            logger.error(f"❌ SELECT error: {e}")
-            return self.emv_responses["COND_NOT_SAT"]
+    def identify_command_type(self, cmd: bytes) -> str:
+        return self._type_by_header.get(cmd[:2], "UNKNOWN")
 
-    def handle_gpo(self, cmd: str, card_data: dict = None) -> str:
-        logger.info("💳 GPO requested")
-        # Simple GPO response
-        aip = "5800"
-        afl = "08010100"
-        data = f"82{len(aip)//2:02X}{aip}94{len(afl)//2:02X}{afl}"
-        response = f"77{len(data)//2:02X}{data}"
-        return response + self.emv_responses["SUCCESS"]
-
-    def handle_read_record(self, cmd: str, card_data: dict = None) -> str:
-        logger.info("📄 READ RECORD requested")
-        # Simple record with PAN and expiry
-        pan = "4111111111111111"
-        exp = "2501"
-        if card_data:
-            pan = card_data.get("pan", pan)
-            exp_date = card_data.get("expiry", "2025-01-01")
-            exp = exp_date[2:4] + exp_date[5:7] if "-" in exp_date else "2501"
-            
-        pan_tag = f"5A{len(pan)//2:02X}{pan}"
-        exp_tag = f"5F24030{exp}"
-        record_data = pan_tag + exp_tag
-        record = f"70{len(record_data)//2:02X}{record_data}"
-        return record + self.emv_responses["SUCCESS"]
-
-    def handle_get_data(self, cmd: str, card_data: dict = None) -> str:
-        tag = cmd[6:10] if len(cmd) >= 10 else ""
-        logger.info(f"📊 GET DATA: {tag}")
+    def handle_select(self, cmd: bytes, card_data: dict = None) -> bytes:
+        # Extract AID from command: CLA INS P1 P2 Lc <AID>
+        aid = cmd[5:5+cmd[4]]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"📱 SELECT AID: {aid.hex().upper()}")
         
-        responses = {
-            "9F36": "9F36020001",  # ATC
-            "9F13": "9F13020001",  # Last Online ATC
-            "9F17": "9F170103"     # PIN Try Counter
-        }
+        response = self._select_response.get(aid)
+        if response is None:
+            logger.warning(f"❌ AID not supported: {aid.hex().upper()}")
+            return _EMV_FILE_NOT_FOUND
+        return response
+
+    def build_pse_response(self) -> bytes:
+        # Build minimal PSE FCI
+        df_name = b"1PAY.SYS.DDF01"
+        fci = _tlv(b"\x6F", _tlv(b"\x84", df_name))
+        return fci + _EMV_SUCCESS
+
+    def build_fci_response(self, aid: bytes, app_name: str) -> bytes:
+        # Build application FCI
+        aid_tag = _tlv(b"\x84", aid)
+        label_tag = _tlv(b"\x50", app_name.encode())
+        fci = _tlv(b"\x6F", aid_tag + label_tag)
+        return fci + _EMV_SUCCESS
+
+    def build_gpo_response(self) -> bytes:
+        # Simple GPO response
+        aip = bytes.fromhex("5800")
+        afl = bytes.fromhex("08010100")
+        data = _tlv(b"\x82", aip) + _tlv(b"\x94", afl)
+        response = _tlv(b"\x77", data)
+        return response + _EMV_SUCCESS
+
+    def handle_gpo(self, cmd: bytes, card_data: dict = None) -> bytes:
+        logger.debug("💳 GPO requested")
+        return self._gpo_response
+
+    @staticmethod
+    def format_expiry(expiry: str) -> bytes:
+        # "YYYY-MM-DD" -> YYMMDD
+        if "-" not in expiry:
+            return bytes.fromhex("250101")
+        return bytes.fromhex(expiry[2:4] + expiry[5:7] + expiry[8:10])
+
+    def prepare_card_data(self, card_data: dict) -> PreparedCard:
+        # Parse card fields once so READ RECORD doesn't re-parse them per APDU
+        pan = card_data.get("pan", "4111111111111111")
+        # ISO/IEC 7812 PANs are at most 19 digits (10 bytes once padded)
+        if len(pan) > 19:
+            raise ValueError(f"PAN too long: {len(pan)} digits")
+        # Odd-length PANs are padded with F
+        pan_bytes = bytes.fromhex(pan + "F" * (len(pan) % 2))
+        expiry = self.format_expiry(card_data.get("expiry", "2025-01-01"))
+        return PreparedCard(pan_bytes, expiry, self.build_record(pan_bytes, expiry))
+
+    def build_record(self, pan: bytes, exp: bytes) -> bytes:
+        # Simple record with PAN and expiry (YYMMDD)
+        pan_tag = _tlv(b"\x5A", pan)
+        exp_tag = _tlv(b"\x5F\x24", exp)
+        record = _tlv(b"\x70", pan_tag + exp_tag)
+        return record + _EMV_SUCCESS
+
+    def handle_read_record(self, cmd: bytes, card_data: dict = None) -> bytes:
+        logger.debug("📄 READ RECORD requested")
+        if not card_data:
+            return self._default_record
+        if not isinstance(card_data, PreparedCard):
+            # Raw inline card_data; parsed per READ RECORD
+            card_data = self.prepare_card_data(card_data)
+        return card_data.record
+
+    def handle_get_data(self, cmd: bytes, card_data: dict = None) -> bytes:
+        # Tag is carried in P1 P2
+        tag = cmd[2:4]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"📊 GET DATA: {tag.hex().upper()}")
         
-        if tag.upper() in responses:
-            return responses[tag.upper()] + self.emv_responses["SUCCESS"]
+        value = _GET_DATA_RESPONSES.get(tag)
+        if value:
+            return value + _EMV_SUCCESS
         
-        return self.emv_responses["FILE_NOT_FOUND"]
+        return _EMV_FILE_NOT_FOUND
 
 apdu_processor = APDUProcessor()
 
+# Background APDU log writer
+@app.on_event("startup")
+async def start_log_writer():
+    if drain_logs is not None:
+        app.state.log_writer = asyncio.create_task(drain_logs())
+
+@app.on_event("shutdown")
+async def stop_log_writer():
+    if drain_logs is not None:
+        app.state.log_writer.cancel()
+        try:
+            await app.state.log_writer
+        except (asyncio.CancelledError, Exception):
+            pass
+
+# ML micro-batcher
+@app.on_event("startup")
+async def start_ml_batcher():
+    if apdu_scorer.available:
+        app.state.ml_batcher = asyncio.create_task(apdu_scorer.run_batcher())
+
+@app.on_event("shutdown")
+async def stop_ml_batcher():
+    if apdu_scorer.available:
+        app.state.ml_batcher.cancel()
+        try:
+            await app.state.ml_batcher
+        except (asyncio.CancelledError, Exception):
+            pass
+
+# Redis broadcast relay
+@app.on_event("startup")
+async def start_broadcast_relay():
+    if manager.redis is not None:
+        app.state.broadcast_relay = asyncio.create_task(manager.relay_broadcasts())
+
+@app.on_event("shutdown")
+async def stop_broadcast_relay():
+    if manager.redis is not None:
+        app.state.broadcast_relay.cancel()
+        try:
+            await app.state.broadcast_relay
+        except (asyncio.CancelledError, Exception):
+            pass
+        await manager.redis.aclose()
+
 # Include routers
 app.include_router(cards.router)
 
@@ -233,35 +468,97 @@ async def root():
 async def status():
     return {
         "connected_devices": manager.get_connected_devices(),
-        "device_count": len(manager.get_connected_devices()),
-        "apdu_commands_processed": len(apdu_processor.command_history),
-        "supported_aids": list(apdu_processor.aid_database.keys())
+        "device_count": manager.connection_count,
+        "apdu_commands_processed": apdu_processor.commands_processed,
+        "devices": {
+            device_id: {
+                "connected_at": _iso(info.connected_at),
+                "last_activity": _iso(time.time_ns() - (time.monotonic_ns() - info.last_activity_ns)),
+                "apdu_count": info.apdu_count
+            }
+            for device_id, info in manager.device_info.items()
+        },
+        "supported_aids": [aid.hex().upper() for aid in _AID_DB]
     }
 
+@app.get("/apdu/history")
+async def apdu_history(limit: int = Query(50, gt=0)):
+    # Walk back from the newest entry so only `limit` items are touched
+    recent = list(itertools.islice(reversed(apdu_processor.command_history), limit))
+    recent.reverse()
+    return [
+        {
+            "timestamp": _iso(ts),
+            "command": cmd.hex().upper(),
+            "type": apdu_processor.identify_command_type(cmd)
+        }
+        for ts, cmd in recent
+    ]
+
 @app.websocket("/ws/apdu")
 async def websocket_endpoint(ws: WebSocket):
     device_id = str(uuid.uuid4())
     await manager.connect(ws, device_id)
+    info = manager.device_info[device_id]
+    session_card = None
     
     try:
         while True:
-            data = await ws.receive_text()
-            msg = json.loads(data)
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            info.last_activity_ns = time.monotonic_ns()
+            data = message.get("bytes")
+            if data is None:
+                await manager.send_frame(_TEXT_FRAME, device_id)
+                continue
+            try:
+                msg = _decoder.decode(data)
+            except msgspec.DecodeError as e:
+                await manager.send_personal_message(
+                    ErrorMsg(message=f"Invalid message: {e}"), device_id
+                )
+                continue
             
-            if msg.get("type") == "apdu_command":
-                cmd = msg["command"]
-                card_data = msg.get("card_data")
+            if isinstance(msg, ApduCommand):
+                try:
+                    cmd = bytes.fromhex(msg.command)
+                except ValueError:
+                    await manager.send_frame(_BAD_HEX_FRAME, device_id)
+                    continue
+                # Inline card_data stays raw: only READ RECORD reads it, and a bad
+                # one is answered there with 6985
+                card_data = msg.card_data or session_card
+                info.apdu_count += 1
                 resp = await apdu_processor.process_apdu(cmd, card_data)
-                await manager.send_personal_message({
-                    "type": "apdu_response", 
-                    "response": resp,
-                    "command": cmd
-                }, device_id)
-            else:
-                await manager.send_personal_message({
-                    "type": "error", 
-                    "message": "Unknown message type"
-                }, device_id)
+                await manager.send_personal_message(
+                    ApduResponse(command=msg.command, response=resp.hex().upper()), device_id
+                )
+            elif isinstance(msg, InitMsg):
+                if msg.card_id is not None:
+                    stored = await card_cache.get(msg.card_id)
+                    if stored is None:
+                        await manager.send_personal_message(
+                            ErrorMsg(message=f"Unknown card_id {msg.card_id}"), device_id
+                        )
+                        continue
+                    try:
+                        session_card = apdu_processor.prepare_card_data(stored)
+                    except (ValueError, TypeError):
+                        # /cards does not validate pan, so a stored card can be bad too
+                        await manager.send_frame(_BAD_CARD_FRAME, device_id)
+                        continue
+                elif msg.card_data:
+                    try:
+                        session_card = apdu_processor.prepare_card_data(msg.card_data)
+                    except (ValueError, TypeError):
+                        await manager.send_frame(_BAD_CARD_FRAME, device_id)
+                        continue
+                else:
+                    session_card = None
+                logger.info(f"🪪 Card data set for {device_id}")
+            elif isinstance(msg, Heartbeat):
+                await manager.send_frame(_HEARTBEAT_FRAME, device_id)
                 
     except WebSocketDisconnect:
         manager.disconnect(device_id)
@@ -271,4 +568,16 @@ async def websocket_endpoint(ws: WebSocket):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
+    # Without REDIS_URL broadcasts are per-process, so stay on a single worker
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        access_log=False,
+        log_level="warning",
+        reload=UVICORN_RELOAD,
+        workers=WEB_CONCURRENCY if REDIS_URL else 1,
+    )
@@ -1,8 +1,10 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-from typing import List
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import AsyncIterator, List
 
-from database import SessionLocal
+import card_cache
+from database import AsyncSessionLocal
 from models import Card
 from schemas import CardCreate, CardRead
 
@@ -10,15 +12,18 @@ router = APIRouter(prefix="/cards", tags=["Cards"])
 
 # ------------- CRUD ---------------
 
-def get_session() -> Session:
-    return SessionLocal()
+async def get_session() -> AsyncIterator[AsyncSession]:
+    # Closed after the response so the connection goes back to the pool
+    async with AsyncSessionLocal() as session:
+        yield session
 
 @router.get("/", response_model=List[CardRead])
-def read_cards(session: Session = Depends(get_session)):
-    return session.query(Card).all()
+async def read_cards(session: AsyncSession = Depends(get_session)):
+    result = await session.scalars(select(Card))
+    return result.all()
 
 @router.post("/", response_model=CardRead, status_code=201)
-def create_card(card: CardCreate, session: Session = Depends(get_session)):
+async def create_card(card: CardCreate, session: AsyncSession = Depends(get_session)):
     db_card = Card(
         holder_name  = card.holder_name,
         pan          = card.pan,
@@ -29,6 +34,7 @@ def create_card(card: CardCreate, session: Session = Depends(get_session)):
         amount       = card.amount,
     )
     session.add(db_card)
-    session.commit()
-    session.refresh(db_card)
+    await session.commit()
+    await session.refresh(db_card)
+    card_cache.put(db_card)
     return db_card
@@ -1,6 +1,7 @@
+import msgspec
 from pydantic import BaseModel, ConfigDict
 from datetime import date
-from typing import Optional
+from typing import Optional, Union
 
 class CardBase(BaseModel):
     holder_name: str
@@ -19,3 +20,26 @@ class CardRead(CardBase):
     
     # Fixed Pydantic V2 configuration
     model_config = ConfigDict(from_attributes=True)
+
+# ------------- WebSocket protocol ---------------
+# Frames on /ws/apdu are MessagePack maps routed by their "type" field.
+
+class InitMsg(msgspec.Struct, tag_field="type", tag="init"):
+    card_data: Optional[dict] = None
+    card_id: Optional[int] = None
+
+class ApduCommand(msgspec.Struct, tag_field="type", tag="apdu_command"):
+    command: str
+    card_data: Optional[dict] = None
+
+class ApduResponse(msgspec.Struct, tag_field="type", tag="apdu_response"):
+    command: str
+    response: str
+
+class Heartbeat(msgspec.Struct, tag_field="type", tag="heartbeat"):
+    pass
+
+class ErrorMsg(msgspec.Struct, tag_field="type", tag="error"):
+    message: str
+
+ClientMessage = Union[InitMsg, ApduCommand, Heartbeat]
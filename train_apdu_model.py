@@ -1,16 +1,48 @@
+import os
+import numpy as np
 import pandas as pd
-from apdu_logger import SessionLocal,APDULog
-from sklearn.feature_extraction.text import CountVectorizer
+from sqlalchemy import select
+from database import engine
+from apdu_logger import APDULog
+from sklearn.feature_extraction.text import HashingVectorizer
 from sklearn.ensemble import RandomForestClassifier
 from joblib import dump
 
 def load_data():
-  db=SessionLocal();logs=db.query(APDULog).all();db.close()
-  df=pd.DataFrame([{"combo":f"{l.apdu_command}|{l.apdu_response}","y":int(l.success)}for l in logs])
-  return df
+  # One Core query streamed in chunks; no ORM objects
+  q=select(APDULog.apdu_command,APDULog.apdu_response,APDULog.success)
+  logs=pd.concat(pd.read_sql(q,engine,chunksize=100_000),ignore_index=True)
+  return pd.DataFrame({"combo":logs["apdu_command"].str.cat(logs["apdu_response"],sep="|"),
+    "y":logs["success"].astype(int)})
 
 df=load_data()
-vec=CountVectorizer(analyzer="char",ngram_range=(1,2))
-X=vec.fit_transform(df["combo"]);y=df["y"]
+# Stateless hashing: fixed 1024 features, no vocabulary to store or look up
+vec=HashingVectorizer(n_features=1024,analyzer="char",ngram_range=(1,2),
+  alternate_sign=False,norm=None,dtype=np.float32)
+X=vec.transform(df["combo"]);y=df["y"]
 model=RandomForestClassifier(n_estimators=100).fit(X,y)
 dump((vec,model),"apdu_model.joblib")
+
+# ONNX export of the forest for fast single-row scoring (vectorizer stays in joblib)
+try:
+  from skl2onnx import convert_sklearn
+  from skl2onnx.common.data_types import FloatTensorType
+  onx=convert_sklearn(model,initial_types=[("combo",FloatTensorType([None,X.shape[1]]))],
+    options={id(model):{"zipmap":False}})
+  # Write then rename, so a crash never leaves a half-written export behind
+  with open("apdu_model.onnx.tmp","wb") as f:f.write(onx.SerializeToString())
+  os.replace("apdu_model.onnx.tmp","apdu_model.onnx")
+except Exception as e:
+  # An export left over from an older forest would disagree with the new joblib
+  print(f"skl2onnx export failed ({e!r}), skipping apdu_model.onnx")
+  if os.path.exists("apdu_model.onnx"):os.remove("apdu_model.onnx")
+
+# Hummingbird GEMM compilation of the same forest; apdu_scorer prefers it when present
+try:
+  from hummingbird.ml import convert,constants
+  hb=convert(model,"onnx",X[:1].toarray(),extra_config={constants.TREE_IMPLEMENTATION:"gemm"})
+  with open("apdu_model.hb.onnx.tmp","wb") as f:f.write(hb.model.SerializeToString())
+  os.replace("apdu_model.hb.onnx.tmp","apdu_model.hb.onnx")
+except Exception as e:
+  print(f"Hummingbird export failed ({e!r}), skipping apdu_model.hb.onnx")
+  if os.path.exists("apdu_model.hb.onnx"):os.remove("apdu_model.hb.onnx")